@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+
+Micro-benchmarks for UDPCP internals. Run: python bench_udpcp.py
+"""
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from Queue import Queue
+from udpcpqueue import SpscQueue
+from udpcpretry import RetryTable
+from udpcpmessage import UdpcpMessage
+from udpcpchecksum import get_backend
+from udpcp import UdpcpConnection
+
+
+def _timed(func, *args):
+    """
+    Run func and return time it took (in seconds).
+    """
+    t = time.time()
+    func(*args)
+    return time.time() - t
+
+
+def _transfer(queue, count, batch):
+    """
+    Move 'count' items from producer thread to consumer through queue.
+    """
+    def producer():
+        for i in xrange(count):
+            queue.put(i)
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    received = 0
+    while received < count:
+        if batch:
+            items = queue.get_many()
+            if not items:
+                items = [queue.get()]
+            received += len(items)
+        else:
+            queue.get()
+            received += 1
+    thread.join()
+
+
+def bench_queue(count=200000):
+    """
+    Compare Queue.Queue with SpscQueue for one producer and one consumer.
+    """
+    print "Queue transfer of {} items:".format(count)
+    results = [('Queue.Queue', _timed(_transfer, Queue(), count, False)),
+               ('SpscQueue.get', _timed(_transfer, SpscQueue(), count, False)),
+               ('SpscQueue.get_many', _timed(_transfer, SpscQueue(), count, True))]
+    for name, t in results:
+        print "\t{:<20} {:8.3f} s {:8.0f} items/s".format(name, t, count / t)
+
+    q = Queue()
+    t = _timed(lambda: [q.empty() for _ in xrange(count)])
+    sq = SpscQueue()
+    st = _timed(lambda: [sq.empty() for _ in xrange(count)])
+    print "\t{} x empty(): Queue.Queue {:.3f} s, SpscQueue {:.3f} s".format(count, t, st)
+
+
+def _sizeof(obj, seen):
+    """
+    Size of object and everything it references (counted once).
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, seen)
+    return size
+
+
+def bench_retry_table(count=20000, payload_size=1400):
+    """
+    Memory per message awaiting ack: dict of lists vs RetryTable.
+    """
+    msgs = []
+    for i in xrange(count):
+        m = UdpcpMessage(payload='{:08}'.format(i) + 'x' * (payload_size - 8))
+        m.header.messageId = i / 8 + 1
+        m.header.fragmentNumber = i % 8
+        msgs.append(m)
+
+    old = {}
+    for m in msgs:
+        old[(m.header.messageId, m.header.fragmentNumber)] = [m, time.time(), 0]
+    table = RetryTable()
+    for m in msgs:
+        table.add(m.header.messageId, m.header.fragmentNumber, str(m.to_bytes()),
+                  time.time())
+
+    # payload (or datagram) itself is needed in both cases
+    old_size = _sizeof(old, set()) - sum(sys.getsizeof(m.payload) for m in msgs)
+    new_size = (_sizeof(table.__dict__, set()) -
+                sum(sys.getsizeof(d) for d in table.datagrams))
+    print "Awaiting ack table, {} entries, overhead per entry (w/o data):".format(count)
+    print "\tdict of [msg, deadline, retries] {:8.1f} B".format(float(old_size) / count)
+    print "\tRetryTable                       {:8.1f} B".format(float(new_size) / count)
+
+    t = _timed(lambda: [m.to_bytes() for m in msgs])
+    print "\tto_bytes() for every entry (skipped on retry now) {:.3f} s".format(t)
+
+
+def bench_checksum(count=20000, payload_size=1400):
+    """
+    Validation of datagrams: verify in a loop vs verify_many, per backend.
+    """
+    datagrams = [UdpcpMessage(payload='{:08}'.format(i) + 'x' * (payload_size - 8)).wire_bytes()
+                 for i in xrange(count)]
+    print "Checksum validation of {} datagrams ({} B payload):".format(count, payload_size)
+    t = _timed(lambda: [UdpcpMessage(d) for d in datagrams])
+    print "\t{:<28} {:8.3f} s".format('UdpcpMessage(data)', t)
+    for name in ('adler32', 'crc32c'):
+        backend = get_backend(name)
+        if name == 'crc32c':
+            # pure Python fallback is too slow for full set
+            datagrams = datagrams[:count / 100]
+        t = _timed(lambda: [backend.verify(d) for d in datagrams])
+        bt = _timed(backend.verify_many, datagrams)
+        print "\t{:<10} verify {:8.3f} s, verify_many {:8.3f} s ({} datagrams)".format(
+            name, t, bt, len(datagrams))
+
+
+def bench_single_fragment(count=20000, payload_size=100):
+    """
+    Receive handling of not fragmented messages: generic multipart path vs
+    single fragment fast path.
+    """
+    conn = UdpcpConnection(('127.0.0.1', 13099), None)
+    msgs = []
+    for i in xrange(count):
+        m = UdpcpMessage(payload='x' * payload_size)
+        m.header.messageId = i + 1
+        m.update_checksum()
+        msgs.append(m)
+
+    print "Receive handling of {} single fragment messages:".format(count)
+    for name, handler in (('generic', conn._handle_fragment),
+                          ('fast path', conn._handle_single_fragment_message)):
+        conn.message_history = {}
+        t = _timed(lambda: [handler(m) for m in msgs])
+        conn.received.get_many()
+        print "\t{:<10} {:8.3f} s {:6.2f} us/message".format(name, t, t / count * 1e6)
+    conn.socket.close()
+
+
+def bench_pcap(count=200000, payload_size=200):
+    """
+    Decoding pcap capture: UdpcpMessage per packet vs udpcppcap.
+    """
+    try:
+        import udpcppcap
+    except ImportError:
+        print "Pcap decoding: numpy not installed, skipped."
+        return
+    fd, path = tempfile.mkstemp(suffix='.pcap')
+    datagrams = []
+    with os.fdopen(fd, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+        for i in xrange(count):
+            m = UdpcpMessage(payload='x' * payload_size)
+            m.header.messageId = i % 0xffff + 1
+            m.update_checksum()
+            datagram = m.wire_bytes()
+            datagrams.append(datagram)
+            udp = struct.pack('>HHHH', 1000, 2000, 8 + len(datagram), 0) + datagram
+            ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                             socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.2'))
+            f.write(struct.pack('<IIII', i / 1000, i % 1000 * 1000, 20 + len(udp),
+                                20 + len(udp)) + ip + udp)
+    print "Decoding pcap with {} packets ({} B payload):".format(count, payload_size)
+    t = _timed(lambda: [UdpcpMessage(d) for d in datagrams])
+    print "\t{:<22} {:8.3f} s (datagrams already extracted)".format('UdpcpMessage(data)', t)
+    t = _timed(lambda: udpcppcap.UdpcpCapture(path).statistics())
+    print "\t{:<22} {:8.3f} s (incl. checksums, flow statistics)".format('UdpcpCapture', t)
+    os.unlink(path)
+
+
+def main():
+    bench_queue()
+    bench_retry_table()
+    bench_checksum()
+    bench_single_fragment()
+    bench_pcap()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,23 @@
 :author: Rafal Jasicki
 :contact: rafal.jasicki@nsn.com
 """
+import os
 import udpcp
+import udpcpqueue
+import udpcpretry
+import udpcpchecksum
+import udpcpstate
+import random
+import zlib
+import socket
+import struct
 import pytest
 import time
 import re
 import copy
+import select
+import threading
+import Queue
 
 
 def create_connections(no_sync=False):
@@ -69,7 +81,7 @@ def test_send_multipart_message():
     assert str(msg_list) == str(listener.received.get())
     # ack received on sender
     assert sender._receive()
-    assert sender.waiting_for_ack == {}
+    assert len(sender.waiting_for_ack) == 0
     # assert False
 
 
@@ -166,7 +178,7 @@ def test_ack():
     assert sender.last_id == 0
     # send the message
     sender._send_from_queue()
-    assert (m.header.messageId, 0) in sender.waiting_for_ack.keys()
+    assert (m.header.messageId, 0) in sender.waiting_for_ack
     # check that ack is required
     assert not listener.received.empty()
     listener.received.get()
@@ -182,7 +194,7 @@ def test_ack():
     assert sender._receive()
     assert sender.received.empty()
     # check if ack was accepted
-    assert (m.header.messageId, 0) not in sender.waiting_for_ack.keys()
+    assert (m.header.messageId, 0) not in sender.waiting_for_ack
 
 
 def test_resend():
@@ -195,7 +207,7 @@ def test_resend():
     sender.ack_delay = 0.1
     sender.max_retries = 4
     sender.send_sync_message()
-    assert (0, 0) in sender.waiting_for_ack.keys()
+    assert (0, 0) in sender.waiting_for_ack
     time.sleep(0.12)
     sender._check_retries()
     # first received copy
@@ -207,7 +219,7 @@ def test_resend():
     # .. is silently discarded
     assert listener.received.empty()
     sender._receive()
-    assert sender.waiting_for_ack == {}
+    assert len(sender.waiting_for_ack) == 0
     sender._receive()
     assert sender.received.empty()
     # [TODO] if possible test if second ack is marked as duplicate
@@ -220,15 +232,15 @@ def test_resend_failed():
     sender.ack_delay = 0.01
     sender.max_retries = 4
     sender.send_sync_message()
-    assert (0, 0) in sender.waiting_for_ack.keys()
+    assert (0, 0) in sender.waiting_for_ack
     for i in xrange(sender.max_retries):
         time.sleep(0.2)
         sender._check_retries()
-        assert sender.waiting_for_ack[(0, 0)][2] == i + 1
+        assert sender.waiting_for_ack.retries[sender.waiting_for_ack.slot(0, 0)] == i + 1
     sender._receive()
-    assert (0, 0) in sender.waiting_for_ack.keys()
+    assert (0, 0) in sender.waiting_for_ack
     sender._check_retries()
-    assert sender.waiting_for_ack == {}
+    assert len(sender.waiting_for_ack) == 0
 
 
 def test_sending_three_part_message_with_payload():
@@ -264,7 +276,7 @@ def test_sending_three_part_message_with_payload():
     assert sender.received.empty()
     sender._receive()
     # check if there is any message watinig for ack
-    assert sender.waiting_for_ack == {}
+    assert len(sender.waiting_for_ack) == 0
 
 
 def test_sending_three_part_message_all_parts_ack_with_payload():
@@ -310,4 +322,506 @@ def test_sending_three_part_message_all_parts_ack_with_payload():
     assert len(sender.waiting_for_ack) == 1
     sender._receive()
     # check if all parts are ACK
-    assert sender.waiting_for_ack == {}
+    assert len(sender.waiting_for_ack) == 0
+
+
+def test_priority_bypasses_large_message():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    sender.max_payload_size = 4
+    large = sender.create_multipart_message(payload="1111222233334444")
+    sender.send_multipart_message(large, priority=udpcp.PRIORITY_LOW)
+    # two fragments of large message go out ...
+    sender._send_from_queue(budget=2)
+    assert len(sender.waiting_for_ack) == 2
+    # ... then control message overtakes the rest of it
+    control = udpcp.UdpcpMessage(payload='ctrl')
+    sender.send(control, priority=udpcp.PRIORITY_HIGH)
+    sender._send_from_queue(budget=1)
+    assert (control.header.messageId, 0) in sender.waiting_for_ack
+    assert control.header.messageId == large[0].header.messageId + 1
+    sender._send_from_queue()
+    assert len(sender.waiting_for_ack) == 5
+    latency = sender.get_queue_latency()
+    assert latency[udpcp.PRIORITY_HIGH]['count'] == 1
+    assert latency[udpcp.PRIORITY_LOW]['count'] == 1
+    assert latency[udpcp.PRIORITY_NORMAL]['count'] == 0
+
+
+def test_same_priority_fragments_interleaved():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    sender.max_payload_size = 4
+    first = sender.create_multipart_message(payload="11112222")
+    second = sender.create_multipart_message(payload="33334444")
+    sender.send_multipart_message(first)
+    sender.send_multipart_message(second)
+    sender._send_from_queue(budget=2)
+    assert sorted(sender.waiting_for_ack) == [(1, 0), (2, 0)]
+    sender._send_from_queue()
+    assert not sender._sending_pending()
+    for i in xrange(4):
+        listener._receive()
+    assert str(first) == str(listener.received.get())
+    assert str(second) == str(listener.received.get())
+
+
+def test_unknown_priority():
+    sender = udpcp.UdpcpConnection(("127.0.0.1", 13001), None)
+    with pytest.raises(ValueError):
+        sender.send(udpcp.UdpcpMessage(), priority=7)
+
+
+def test_spsc_queue():
+    q = udpcpqueue.SpscQueue()
+    assert q.empty()
+    with pytest.raises(Queue.Empty):
+        q.get(block=False)
+    with pytest.raises(Queue.Empty):
+        q.get(timeout=0.01)
+    q.put(1)
+    q.put_many([2, 3, 4])
+    assert q.qsize() == 4
+    assert select.select([q], [], [], 0)[0]
+    assert q.get() == 1
+    assert q.get_many(2) == [2, 3]
+    assert q.get_many() == [4]
+    assert q.empty()
+    # wake-ups are consumed together with items
+    assert not select.select([q], [], [], 0)[0]
+    q.close()
+
+
+def test_spsc_queue_wakes_consumer():
+    q = udpcpqueue.SpscQueue()
+    t = threading.Timer(0.05, q.put, ['x'])
+    t.start()
+    assert q.get(timeout=2) == 'x'
+    t.join()
+
+
+def test_retry_table():
+    table = udpcpretry.RetryTable()
+    slot = table.add(0x1234, 2, 'data', 10.0, single_ack=False)
+    assert table.keys[slot] == 0x123402
+    assert (0x1234, 2) in table
+    assert table.message_id(slot) == 0x1234
+    assert table.fragment_number(slot) == 2
+    assert not table.single_ack[slot]
+    assert table.expired(9.0) == []
+    assert table.expired(10.0) == [slot]
+    table.remove(0x1234, 2)
+    assert len(table) == 0
+    # freed slot is reused
+    assert table.add(1, 0, 'other', 1.0) == slot
+    assert list(table) == [(1, 0)]
+    assert table.datagrams[slot] == 'other'
+
+
+def test_wire_bytes_cache():
+    m = udpcp.UdpcpMessage(payload='<xml></xml>')
+    data = m.wire_bytes()
+    assert data == str(m.to_bytes())
+    # cached bytes are reused
+    assert m.wire_bytes() is data
+    # changed header is never sent stale, even without update_checksum
+    m.header.noAck = True
+    assert m.wire_bytes() == str(m.to_bytes())
+    assert udpcp.UdpcpMessage(m.wire_bytes(), validate=False).header.noAck
+    m.header.noAck = False
+    assert m.wire_bytes() == data
+    m.header.messageId = 5
+    m.update_checksum()
+    assert m.wire_bytes() is not data
+    data = m.wire_bytes()
+    assert data == str(m.to_bytes())
+    assert udpcp.UdpcpMessage(data).header.messageId == 5
+    m.payload = '<xml/>'
+    assert m.wire_bytes() == str(m.to_bytes())
+
+
+def legacy_checksum(data):
+    cs = zlib.adler32(buffer(data))
+    if cs % 0xffffffff != cs:
+        cs = (cs % 0xffffffff) + 1
+    return cs
+
+
+def test_adler32_backend_matches_legacy_checksum():
+    rnd = random.Random(1234)
+    backend = udpcpchecksum.default_backend
+    for _ in xrange(500):
+        data = bytearray(rnd.getrandbits(8) for _ in xrange(rnd.randint(0, 3000)))
+        assert backend.calculate(data) == legacy_checksum(data)
+        datagram = '\0\0\0\0' + str(data)
+        assert backend.calculate_for_datagram(datagram) == legacy_checksum(datagram)
+
+
+def test_verify_many():
+    rnd = random.Random(4321)
+    datagrams = []
+    for _ in xrange(50):
+        m = udpcp.UdpcpMessage(payload=''.join(chr(rnd.getrandbits(8))
+                                               for _ in xrange(rnd.randint(1, 200))))
+        datagrams.append(m.wire_bytes())
+    corrupted = bytearray(datagrams[3])
+    corrupted[-1] ^= 0xff
+    datagrams[3] = str(corrupted)
+    datagrams.append('short')
+    result = udpcpchecksum.default_backend.verify_many(datagrams)
+    assert result == [i != 3 for i in xrange(50)] + [False]
+    assert result[:50] == [udpcpchecksum.default_backend.verify(d) for d in datagrams[:50]]
+
+
+def test_crc32c_backend():
+    backend = udpcpchecksum.get_backend('crc32c')
+    assert backend.calculate('123456789') == 0xe3069283
+    m = udpcp.UdpcpMessage(payload='<xml></xml>', checksum_backend=backend)
+    assert backend.verify(m.wire_bytes())
+    with pytest.raises(udpcp.CorruptedMessage):
+        udpcp.UdpcpMessage(m.wire_bytes())
+    with pytest.raises(ValueError):
+        udpcpchecksum.get_backend('md5')
+
+
+def test_connection_with_crc32c():
+    listener, sender = create_connections()
+    listener.checksum_backend = sender.checksum_backend = udpcpchecksum.get_backend('crc32c')
+    sender.send(udpcp.UdpcpMessage(payload='<xml></xml>'))
+    sender.send_sync_message()
+    listener._receive()
+    sender._receive()
+    assert sender.last_id == 0
+    sender._send_from_queue()
+    listener._receive()
+    listener.received.get()
+    assert listener.received.get()[0].payload == '<xml></xml>'
+    sender._receive()
+    assert len(sender.waiting_for_ack) == 0
+
+
+def test_single_fragment_fast_path():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    m = udpcp.UdpcpMessage(payload='<xml></xml>')
+    sender.send(m)
+    sender._send_from_queue()
+    # resent copy is acked as duplicate but not delivered
+    sender._send(m)
+    assert listener._receive()
+    assert listener._receive()
+    assert [m2.payload for m2 in listener.received.get()] == ['<xml></xml>']
+    assert listener.received.empty()
+    assert listener.message_parts == {}
+    assert m.header.messageId in listener.message_history
+    assert sender._receive()
+    assert len(sender.waiting_for_ack) == 0
+    # not fragmented message has only fragment 0
+    m.header.fragmentNumber = 1
+    m.header.messageId = 10
+    m.update_checksum()
+    sender._send(m)
+    assert listener._receive()
+    assert listener.received.empty()
+    assert 10 not in listener.message_history
+
+
+def write_pcap(path, packets):
+    """
+    Write Ethernet/IPv4/UDP pcap, packets are (time, src port, dst port, datagram).
+    """
+    with open(str(path), 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for t, sport, dport, datagram in packets:
+            udp = struct.pack('>HHHH', sport, dport, 8 + len(datagram), 0) + datagram
+            ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                             socket.inet_aton('10.0.0.1' if sport == 1000 else '10.0.0.2'),
+                             socket.inet_aton('10.0.0.2' if sport == 1000 else '10.0.0.1'))
+            frame = '\0' * 12 + '\x08\x00' + ip + udp
+            f.write(struct.pack('<IIII', int(t), int(round(t % 1 * 1e6)),
+                                len(frame), len(frame)))
+            f.write(frame)
+        # truncated record at the end is ignored
+        f.write(struct.pack('<IIII', 0, 0, 100, 100) + 'xx')
+
+
+def test_pcap_decoder(tmpdir):
+    pytest.importorskip('numpy')
+    import udpcppcap
+    sender = udpcp.UdpcpConnection(('127.0.0.1', 13001), None)
+    sender.last_id = 0
+    sender.max_payload_size = 4
+    msgs = sender.create_multipart_message('111122223333')
+    for i, m in enumerate(msgs):
+        sender.update_msg(m, message_id=None if i == 0 else 1, part=i, count=3)
+    single = udpcp.UdpcpMessage(payload='abc')
+    sender.update_msg(single)
+    corrupted = bytearray(single.wire_bytes())
+    corrupted[-1] = ord('x')
+    packets = [
+        (10.0, 1000, 2000, msgs[0].wire_bytes()),
+        (10.1, 1000, 2000, msgs[0].wire_bytes()),     # retransmission
+        (10.2, 1000, 2000, msgs[2].wire_bytes()),     # fragment 1 lost
+        (10.25, 2000, 1000, msgs[0].create_ack(False).wire_bytes()),
+        (10.5, 1000, 2000, str(corrupted)),
+        (10.6, 1000, 2000, single.wire_bytes()),
+        (10.8, 2000, 1000, single.create_ack(False).wire_bytes()),
+        (11.0, 1000, 2000, 'not udpcp'),
+    ]
+    path = tmpdir.join('trace.pcap')
+    write_pcap(path, packets)
+
+    capture = udpcppcap.UdpcpCapture(str(path))
+    h = capture.headers
+    assert len(h) == 7
+    assert list(h['messageId']) == [1, 1, 1, 1, 2, 2, 2]
+    assert list(h['fragmentNumber']) == [0, 0, 2, 0, 0, 0, 0]
+    assert list(h['messageType']) == [1, 1, 1, 2, 1, 1, 2]
+    assert list(h['valid']) == [True, True, True, True, False, True, True]
+    assert abs(h['time'][3] - 10.25) < 1e-6
+    assert capture.datagram(5) == single.wire_bytes()
+    assert list(udpcppcap.validate_checksums(capture.buf, h.copy(), 'crc32c')) == \
+        [False, False, False, False, False, False, False]
+
+    stats = capture.statistics()
+    assert stats.keys() == [('10.0.0.1', 1000, '10.0.0.2', 2000)]
+    flow = stats.values()[0]
+    assert flow['packets'] == 7
+    assert flow['data'] == 4
+    assert flow['acks'] == 2
+    assert flow['invalid'] == 1
+    assert flow['retransmissions'] == 1
+    assert flow['lost_fragments'] == 1
+    assert flow['duplicate_ids'] == 0
+    assert flow['ack_latency']['count'] == 2
+    assert abs(flow['ack_latency']['max'] - 0.25) < 1e-6
+    capture.close()
+
+
+def test_pcap_message_id_epochs(tmpdir):
+    pytest.importorskip('numpy')
+    import udpcppcap
+
+    def message(m_id, payload):
+        m = udpcp.UdpcpMessage(payload=payload)
+        m.header.messageId = m_id
+        m.header.dataLength = len(payload)
+        m.update_checksum()
+        return m
+
+    sync = udpcp.UdpcpMessage()
+    sync.update_checksum()
+    sent = [(0.0, message(0xfffe, 'a')), (0.1, message(0xffff, 'bb')),
+            (0.2, message(1, 'ccc')),
+            (0.3, message(0xffff, 'bb')),       # retransmission after wrap
+            (1.0, sync), (1.1, message(1, 'dddd')),     # re-sync, ID 1 again
+            (100.0, message(1, 'eeeee'))]               # restart without sync
+    packets = []
+    for t, m in sent:
+        packets.append((t, 1000, 2000, m.wire_bytes()))
+        packets.append((t + 0.01, 2000, 1000, m.create_ack(False).wire_bytes()))
+    packets.append((0.5, 1000, 3000, message(7, 'x').wire_bytes()))
+    path = tmpdir.join('trace.pcap')
+    write_pcap(path, packets)
+
+    capture = udpcppcap.UdpcpCapture(str(path), ports=[2000])
+    assert len(capture.headers) == 2 * len(sent)
+    flow = capture.statistics()[('10.0.0.1', 1000, '10.0.0.2', 2000)]
+    assert flow['duplicate_ids'] == 0
+    assert flow['retransmissions'] == 1
+    assert flow['lost_fragments'] == 0
+    assert flow['ack_latency']['count'] == 6
+    # without time gap two messages with ID 1 are mixed
+    flow = capture.statistics(epoch_gap=None)[('10.0.0.1', 1000, '10.0.0.2', 2000)]
+    assert flow['duplicate_ids'] == 1
+    assert len(udpcppcap.UdpcpCapture(str(path)).headers) == 2 * len(sent) + 1
+    capture.close()
+
+
+def test_compressed_message():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    listener.compression = sender.compression = True
+    sender.max_payload_size = 100
+    payload = "<SOAP-ENV:Envelope />" * 100
+    msgs = sender.create_multipart_message(payload)
+    assert len(msgs) < len(payload) / 100 / 10
+    assert all(m.header.compressed for m in msgs)
+    small = sender.create_multipart_message(payload[:100])
+    assert not small[0].header.compressed
+    sender.send_multipart_message(msgs)
+    sender.send_multipart_message(small)
+    sender._send_from_queue()
+    for i in xrange(len(msgs) + 1):
+        listener._receive()
+    assert ''.join(m.payload for m in listener.received.get()) == payload
+    assert listener.received.get()[0].payload == payload[:100]
+    sender._receive()
+    sender._receive()
+    assert len(sender.waiting_for_ack) == 0
+
+
+def test_compressed_multipart_message():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    listener.compression = sender.compression = True
+    sender.max_payload_size = 100
+    r = random.Random(1)
+    payload = ''.join('<v>{}</v>'.format(r.randint(0, 10 ** 6)) for i in xrange(500))
+    msgs = sender.create_multipart_message(payload)
+    assert 1 < len(msgs) < len(payload) / 100
+    sender.send_multipart_message(msgs)
+    sender._send_from_queue()
+    for m in msgs:
+        listener._receive()
+    parts = listener.received.get(timeout=1)
+    assert ''.join(m.payload for m in parts) == payload
+    assert not any(m.header.compressed for m in parts)
+    assert all(m.header.dataLength == len(payload) for m in parts)
+    sender._receive()
+    assert len(sender.waiting_for_ack) == 0
+
+    # decompressed size is limited
+    listener.max_decompressed_size = len(payload) - 1
+    sender.send_multipart_message(sender.create_multipart_message(payload))
+    sender._send_from_queue()
+    for m in msgs:
+        listener._receive()
+    assert listener.received.empty()
+    assert not sender._receive(False)
+
+
+def test_compressed_message_not_enabled():
+    listener, sender = create_connections(no_sync=True)
+    sender.sync()
+    sender.compression = True
+    sender.ack_delay = 0
+    sender.max_retries = 1
+    for single_ack, size in ((True, 2048), (True, 8), (False, 8)):
+        sender.singleAck = single_ack
+        sender.max_payload_size = size
+        sender.send_multipart_message(sender.create_multipart_message('x' * 5000))
+        sender._send_from_queue()
+        # not delivered, so not acked -- sender reports failure after retries
+        for i in xrange(2):
+            while listener._receive(False):
+                continue
+            while sender._receive(False):
+                continue
+            sender._check_retries()
+        assert sender.status_queue.get(timeout=1)[0] == 'Message failed'
+        assert listener.received.empty()
+        assert len(sender.waiting_for_ack) == 0
+
+    # random data do not compress -- sent raw
+    sender.max_payload_size = 1000
+    msgs = sender.create_multipart_message(os.urandom(5000))
+    assert len(msgs) == 5
+    assert not any(m.header.compressed for m in msgs)
+
+
+def test_state_snapshot_restore(tmpdir):
+    listener, sender = create_connections()
+    sender.send_sync_message()
+    listener._receive()
+    listener.received.get()
+    sender._receive()
+    sender.ack_delay = 0.05
+    sender.max_payload_size = 4
+    sender.send_multipart_message(sender.create_multipart_message('111122223333'))
+    sender._send_from_queue()
+    # listener restarts after first part, other parts are lost with its socket
+    listener._receive()
+    path = str(tmpdir.join('listener'))
+    listener.save_state(path)
+    local = ('127.0.0.1', listener.socket.getsockname()[1])
+    listener.socket.close()
+    listener = udpcp.UdpcpConnection(listener.target, local)
+    assert listener.restore_state(path)
+    time.sleep(0.06)
+    sender._check_retries()
+    for i in xrange(3):
+        listener._receive()
+    assert ''.join(m.payload for m in listener.received.get(timeout=1)) == '111122223333'
+    while sender._receive(False):
+        continue
+    assert len(sender.waiting_for_ack) == 0
+
+    # sender restarts before it gets ack
+    m = udpcp.UdpcpMessage(payload='<xml></xml>')
+    sender.send(m)
+    with pytest.raises(udpcpstate.StateError):
+        sender.save_state(str(tmpdir.join('sender')))
+    sender._send_from_queue()
+    listener._receive()
+    listener.received.get(timeout=1)
+    path = str(tmpdir.join('sender'))
+    sender.save_state(path)
+    local = ('127.0.0.1', sender.socket.getsockname()[1])
+    sender.socket.close()
+    sender = udpcp.UdpcpConnection(sender.target, local)
+    assert not sender.restore_state(path, max_age=-1)
+    # peer would reject datagrams with other checksum
+    assert not udpcp.UdpcpConnection(sender.target, None,
+                                     checksum='crc32c').restore_state(path)
+    assert sender.restore_state(path)
+    with pytest.raises(udpcpstate.StateError):
+        sender.restore_state(path)
+    assert sender.last_id == 2
+    assert len(sender.waiting_for_ack) == 1
+    # no sync needed, pending message is retransmitted at once
+    sender.sync()
+    sender._check_retries()
+    listener._receive()
+    assert listener.received.empty()
+    sender._receive()
+    assert len(sender.waiting_for_ack) == 0
+
+    other = udpcp.UdpcpConnection(('127.0.0.1', 1), None)
+    assert not other.restore_state(path)
+
+
+def test_load_generator():
+    import udpcpload
+    import StringIO
+    output = StringIO.StringIO()
+    report = udpcpload.run(pairs=2, rate=50, size=3000, size_distribution='uniform',
+                           max_payload_size=1000, duration=0.5, interval=0.2, seed=1,
+                           output=output)
+    assert report['acked'] > 0
+    assert report['failed'] == 0
+    assert report['ack latency ms']['max'] >= report['ack latency ms']['p50']
+    # latency is not dominated by send period (20 ms)
+    assert report['ack latency ms']['p50'] < 10
+    assert report['queue ms']['max'] >= report['queue ms']['average']
+    assert output.getvalue().count('\n') >= 2
+    assert 'total:' in output.getvalue()
+
+
+def test_spsc_queue_put_many_wakes_consumer():
+    q = udpcpqueue.SpscQueue()
+    q.put('old')
+    # consumer takes last item and waits while producer adds more
+    assert q.get() == 'old'
+    t = threading.Timer(0.05, q.put_many, [['a', 'b']])
+    t.start()
+    assert q.get(timeout=2) == 'a'
+    t.join()
+
+
+def test_spsc_queue_many_producers():
+    q = udpcpqueue.SpscQueue()
+    q.put_nowait(1)
+    assert q.get_nowait() == 1
+    with pytest.raises(Queue.Empty):
+        q.get_nowait()
+    count = 5000
+    producers = [threading.Thread(target=lambda: [q.put(i) for i in xrange(count)])
+                 for _ in xrange(3)]
+    for p in producers:
+        p.start()
+    # no wake-up is lost when producers race
+    items = [q.get(timeout=2) for _ in xrange(3 * count)]
+    for p in producers:
+        p.join()
+    assert sorted(items) == sorted(range(count) * 3)
@@ -5,14 +5,30 @@
 :contact: rafal.jasicki@nsn.com
 """
 import socket
+import select
 import zlib
+import itertools
 import threading
-from Queue import Queue
+from collections import deque
 from udpcpmessage import UdpcpMessage, CorruptedMessage
+from udpcpqueue import SpscQueue
+from udpcpretry import RetryTable
+from udpcpchecksum import get_backend
+import udpcpstate
 import logging
 import time
 
 
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_CLASSES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# bytes of payload given to compressor at once
+COMPRESSION_STEP = 0x10000
+# largest payload dataLength can describe -- compressed messages must not
+# decompress to more
+MAX_DECOMPRESSED_SIZE = 0xffff
 
 
 class UdpcpSyncFailed(Exception):
@@ -21,7 +37,9 @@ class UdpcpSyncFailed(Exception):
 
 class UdpcpConnectionInternal(object):
     def __init__(self, target, local=('127.0.0.1', 13001), timeout=0.05,
-                 ack_delay=2.0, max_retries=8, max_payload_size=2048, no_sync=False):
+                 ack_delay=2.0, max_retries=8, max_payload_size=2048, no_sync=False,
+                 send_budget=16, checksum='adler32', compression=False,
+                 compression_threshold=1024):
         self.no_sync = no_sync
         self.target = target
         self.local = local
@@ -30,15 +48,30 @@ class UdpcpConnectionInternal(object):
             self.socket.bind(self.local)
         self.socket.settimeout(timeout)
         self.alive = False
-        self.received = Queue()
-        self.send_queue = Queue()
-        self.status_queue = Queue()
-        self.waiting_for_ack = {}
+        self.received = SpscQueue()
+        self.send_queue = SpscQueue()
+        # (status, kind, message ID, first part sent, status time); for not
+        # acked and failed messages status comes for every part
+        self.status_queue = SpscQueue()
+        # messages taken from send_queue, one FIFO per priority class
+        self.pending = [deque() for _ in PRIORITY_CLASSES]
+        # [count, total, max] of queue-time (seconds) per priority class
+        self.queue_latency = [[0, 0.0, 0.0] for _ in PRIORITY_CLASSES]
+        self.send_budget = send_budget
+        # must be the same on both ends of the link
+        self.checksum_backend = get_backend(checksum)
+        # payloads of at least compression_threshold bytes are sent compressed,
+        # must be enabled on both ends of the link
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.max_decompressed_size = MAX_DECOMPRESSED_SIZE
+        self.waiting_for_ack = RetryTable()
         self.last_id = None
         self.noAck = False
         self.singleAck = True
         self.ack_delay = ack_delay
         self.max_retries = max_retries
+        self.retransmissions = 0
         self.message_history = {}
         self.max_payload_size = max_payload_size
         self.message_parts = {}
@@ -50,6 +83,7 @@ class UdpcpConnectionInternal(object):
         Update message with correct ID (before sending).
         """
 
+        msg.checksum_backend = self.checksum_backend
         msg.header.noAck = self.noAck
         msg.header.singleAck = self.singleAck
         if message_id is None:
@@ -66,19 +100,23 @@ class UdpcpConnectionInternal(object):
         msg.header.fragmentNumber = part
         msg.update_checksum()
 
-    def _register_message(self, msg):
+    def _register_message(self, msg, sent=None):
         """
         If message needs to be acked by other side it should be registered here.
+        'sent' is time the first part of message was sent (now if None).
         """
+        now = time.time()
+        if sent is None:
+            sent = now
         if msg.header.noAck:
-            self.status_queue.put(('Message sent', 'no ack', msg.header.messageId))
+            self.status_queue.put(('Message sent', 'no ack', msg.header.messageId, sent, now))
             return
         self.logger.info("Message awaiting ack added "
                                       "(id: {}, part: {}).".format(msg.header.messageId,
                                                                    msg.header.fragmentNumber))
-        self.waiting_for_ack[(msg.header.messageId,
-                              msg.header.fragmentNumber)] = [msg, time.time() +
-                                                             self.ack_delay, 0]
+        self.waiting_for_ack.add(msg.header.messageId, msg.header.fragmentNumber,
+                                 msg.wire_bytes(), now + self.ack_delay,
+                                 msg.header.singleAck, sent)
 
     def _check_retries(self):
         """
@@ -87,24 +125,26 @@ class UdpcpConnectionInternal(object):
         will be sent to status_queue.
         """
         t = time.time()
-        for (msg_id, fragmentNumber), item in self.waiting_for_ack.items():
-            if item[1] > t:
-                continue
-            if item[2] < self.max_retries:
-                self._send(item[0])
-                item[2] += 1
-                item[1] = t + self.ack_delay
+        table = self.waiting_for_ack
+        for slot in table.expired(t):
+            if table.retries[slot] < self.max_retries:
+                self.socket.sendto(table.datagrams[slot], self.target)
+                table.retries[slot] += 1
+                table.deadlines[slot] = t + self.ack_delay
+                self.retransmissions += 1
                 continue
             self.logger.info("Message discarded due to exceeded number of retries.")
-            self.status_queue.put(('Message failed', 'ack', msg_id))
-            del self.waiting_for_ack[(msg_id, fragmentNumber)]
+            self.status_queue.put(('Message failed', 'ack', table.message_id(slot),
+                                   table.sent[slot], t))
+            table.remove_slot(slot)
 
     def send_sync_message(self):
         """
         Send synchronisation message at start of UDPCP communication.
         """
         if (0, 0) not in self.waiting_for_ack:
-            sync_msg = UdpcpMessage()
+            sync_msg = UdpcpMessage(checksum_backend=self.checksum_backend)
+            sync_msg.update_checksum()
             self.message_history = {}
             self._send(sync_msg)
             self._register_message(sync_msg)
@@ -138,27 +178,84 @@ class UdpcpConnectionInternal(object):
         # self.logger.debug("\nBYTES:\n{}".format(msg.to_bytes()))
         self.logger.debug("\nTARGET:\n{}".format(self.target))
 
-        self.socket.sendto(msg.to_bytes(), self.target)
+        self.socket.sendto(msg.wire_bytes(), self.target)
 
-    def _send_from_queue(self):
+    def _schedule(self):
         """
-        Take message from queue and prepare it for sending.
+        Move messages from send_queue to pending queues of their priority class.
         """
-        msgs = self.send_queue.get()
-        inx = 0
-        count = len(msgs)
-        for m in msgs:
+        for priority, msgs, queued in self.send_queue.get_many():
+            self.pending[priority].append([msgs, 0, None, queued, None])
+
+    def _sending_pending(self):
+        """
+        Check if there is anything left to send.
+        """
+        return not self.send_queue.empty() or any(self.pending)
+
+    def _next_pending(self):
+        """
+        Return the highest priority class that has message to send.
+        """
+        for priority in PRIORITY_CLASSES:
+            if self.pending[priority]:
+                return priority
+        return None
+
+    def _update_queue_latency(self, priority, queued):
+        """
+        Record time message spent in queue before its first fragment was sent.
+        """
+        stats = self.queue_latency[priority]
+        delay = time.time() - queued
+        stats[0] += 1
+        stats[1] += delay
+        stats[2] = max(stats[2], delay)
+
+    def get_queue_latency(self):
+        """
+        Get queue-time statistics (in seconds) for every priority class.
+        """
+        return [{'count': count,
+                 'average': total / count if count else 0.0,
+                 'max': maximum}
+                for count, total, maximum in self.queue_latency]
+
+    def _send_from_queue(self, budget=None):
+        """
+        Take messages from queue and send them fragment by fragment.
+        Higher priority messages are sent first, fragments of messages with the same
+        priority are interleaved. At most 'budget' fragments are sent (all if None).
+        Returns ID of last message sent.
+        """
+        self._schedule()
+        m_id = None
+        sent = 0
+        while budget is None or sent < budget:
+            priority = self._next_pending()
+            if priority is None:
+                break
+            queue = self.pending[priority]
+            item = queue.popleft()
+            msgs, inx, m_id, queued, first_sent = item
+            m = msgs[inx]
+            count = len(msgs)
             if inx == 0:
                 self.update_msg(m, part=inx, count=count)
-                m_id = m.header.messageId
+                m_id = item[2] = m.header.messageId
+                first_sent = item[4] = time.time()
+                self._update_queue_latency(priority, queued)
             else:
                 self.update_msg(m, message_id=m_id, part=inx, count=count)
             self.logger.debug("Message {m.header.messageId}, {m.header.fragmentNumber} ready for sending.".format(m=m))
             if count > 1:
                 self.logger.debug("This is multipart ({}/{}) message".format(inx+1, count))
             self._send(m)
-            self._register_message(m)
-            inx += 1
+            self._register_message(m, first_sent)
+            sent += 1
+            item[1] = inx + 1
+            if item[1] < count:
+                queue.append(item)
         return m_id
 
     def _ack(self, msg, duplicate=False):
@@ -173,10 +270,13 @@ class UdpcpConnectionInternal(object):
         self.logger.info("Ack for message (id: {}) created.".format(ack_msg.header.messageId))
         self._send(ack_msg)
 
-    def _receive(self):
+    def _receive(self, wait=True):
         """
         Receive data from socket.
+        If 'wait' is False return immediately when there is no data.
         """
+        if not wait and not select.select([self.socket], [], [], 0)[0]:
+            return False
         try:
             data = self.socket.recv(4096)
         except socket.timeout as e:
@@ -197,7 +297,7 @@ class UdpcpConnectionInternal(object):
         Try creating message from data and handle it.
         """
         try:
-            m = UdpcpMessage(data)
+            m = UdpcpMessage(data, checksum_backend=self.checksum_backend)
         except CorruptedMessage as e:
             self.logger.warn("Corrupted data: {}".format(e))
             return True
@@ -217,35 +317,62 @@ class UdpcpConnectionInternal(object):
         """
         After receiving ack remove it from dictionary of messages that require acking.
         """
-        if (msg.header.messageId, msg.header.fragmentNumber) not in self.waiting_for_ack:
+        slot = self.waiting_for_ack.slot(msg.header.messageId, msg.header.fragmentNumber)
+        if slot is None:
             return
-        m = self.waiting_for_ack[(msg.header.messageId, msg.header.fragmentNumber)][0]
-        if not m.header.singleAck:
-            self._handle_ack_multi(msg)
+        sent = self.waiting_for_ack.sent[slot]
+        if not self.waiting_for_ack.single_ack[slot]:
+            self._handle_ack_multi(msg, sent)
             return
-        self._handle_ack_single(msg)
+        self._handle_ack_single(msg, sent)
 
-    def _handle_ack_single(self, msg):
+    def _handle_ack_single(self, msg, sent):
         """Ack for single-ack messages"""
         for n in xrange(msg.header.fragmentAmount):
-            if (msg.header.messageId, n) in self.waiting_for_ack:
-                del self.waiting_for_ack[(msg.header.messageId, n)]
-        self.status_queue.put(('Message sent', 'ack', msg.header.messageId))
+            self.waiting_for_ack.remove(msg.header.messageId, n)
+        self.status_queue.put(('Message sent', 'ack', msg.header.messageId, sent, time.time()))
         self.logger.debug("Message id:{} acked (single ack).".format(msg.header.messageId))
 
-    def _handle_ack_multi(self, msg):
+    def _handle_ack_multi(self, msg, sent):
         """Ack for multi-ack messages"""
-        del self.waiting_for_ack[(msg.header.messageId, msg.header.fragmentNumber)]
+        self.waiting_for_ack.remove(msg.header.messageId, msg.header.fragmentNumber)
         for n in xrange(msg.header.fragmentAmount):
             if (msg.header.messageId, n) in self.waiting_for_ack:
                 return
-        self.status_queue.put(('Message sent', 'ack', msg.header.messageId))
+        self.status_queue.put(('Message sent', 'ack', msg.header.messageId, sent, time.time()))
         self.logger.debug("Message id:{} acked (multiple ack).".format(msg.header.messageId))
 
     def _handle_data_message(self, msg):
         """
         Handle received data message.
         """
+        if msg.header.fragmentAmount <= 1:
+            return self._handle_single_fragment_message(msg)
+        return self._handle_fragment(msg)
+
+    def _handle_single_fragment_message(self, msg):
+        """
+        Handle not fragmented message -- deliver and ack it at once.
+        """
+        m_id = msg.header.messageId
+        if msg.header.fragmentNumber:
+            self.logger.warn("Fragment {} of not fragmented message "
+                             "(id: {}).".format(msg.header.fragmentNumber, m_id))
+            return True
+        if m_id in self.message_history:
+            self.logger.info("Duplicate received.")
+            self._ack(msg)
+            return True
+        parts = [msg]
+        if self._deliver(parts):
+            self.message_history[m_id] = parts
+            self._ack(msg)
+        return True
+
+    def _handle_fragment(self, msg):
+        """
+        Handle fragment of multipart message.
+        """
         m_id = msg.header.messageId
         handled = False
         if m_id in self.message_history:
@@ -263,7 +390,8 @@ class UdpcpConnectionInternal(object):
                                                              msg.header.fragmentAmount))
             self.message_parts[m_id][msg.header.fragmentNumber] = msg
             handled = True
-            if not msg.header.singleAck:
+            # last part is acked when message is delivered
+            if not msg.header.singleAck and None in self.message_parts[m_id]:
                 self._ack(msg)
         else:
             self.logger.info("Duplicate received.")
@@ -278,14 +406,67 @@ class UdpcpConnectionInternal(object):
         m_id = msg.header.messageId
         if None not in self.message_parts[m_id]:
             self.logger.info("Multipart message with id:{} complete.".format(m_id))
-            self.received.put(self.message_parts[m_id])
-            self.message_history[m_id] = self.message_parts[m_id]
-            if msg.header.singleAck:
-                self._ack(self.message_history[m_id][0])
+            parts = self.message_parts[m_id]
+            if not self._deliver(parts):
+                # not acked, so sender retransmits and finally reports failure
+                # (with multiple acks only the last part is not acked yet)
+                if msg.header.singleAck:
+                    del self.message_parts[m_id]
+                else:
+                    parts[msg.header.fragmentNumber] = None
+                return True
+            self.message_history[m_id] = parts
+            self._ack(parts[0] if msg.header.singleAck else msg)
             del self.message_parts[m_id]
             return True
         return False
 
+    def _deliver(self, parts):
+        """
+        Put complete message to received queue (decompress it if needed).
+        Returns False if message cannot be delivered.
+        """
+        if parts[0].header.compressed:
+            if not self.compression:
+                self.logger.error("Compressed message (id: {}) received but compression "
+                                  "is not enabled.".format(parts[0].header.messageId))
+                return False
+            try:
+                self._decompress(parts)
+            except (zlib.error, ValueError) as e:
+                self.logger.error("Decompression of message (id: {}) "
+                                  "failed: {}".format(parts[0].header.messageId, e))
+                return False
+        self.received.put(parts)
+        return True
+
+    def _decompress(self, parts):
+        """
+        Replace compressed payloads of message parts with decompressed data
+        (at most max_decompressed_size bytes, ValueError if there are more).
+        """
+        limit = self.max_decompressed_size
+        decompressor = zlib.decompressobj()
+        payloads = []
+        length = 0
+        for part in parts:
+            # one byte over limit shows it is exceeded (and 0 would mean no limit)
+            payloads.append(decompressor.decompress(part.payload or '', limit - length + 1))
+            length += len(payloads[-1])
+            if length > limit or decompressor.unconsumed_tail:
+                break
+        else:
+            tail = decompressor.flush()
+            payloads[-1] += tail
+            length += len(tail)
+        if length > limit or decompressor.unconsumed_tail:
+            raise ValueError("Message exceeds {} bytes when decompressed.".format(limit))
+        # parts are left untouched if decompression fails
+        for part, payload in zip(parts, payloads):
+            part.payload = payload
+            part.header.compressed = False
+            part.header.dataLength = length
+
     def _handle_received_ack(self, msg):
         """
         Handle received ack-message.
@@ -305,22 +486,26 @@ class UdpcpConnectionInternal(object):
         self.logger.info("Starting listening on {}.".format(self.local))
         self.alive = True
         while self.alive:
-            while self._receive():
+            if not self._sending_pending():
+                # wait for incoming data or for new message to send
+                select.select([self.socket, self.send_queue], [], [],
+                              self.socket.gettimeout())
+            while self._receive(False):
                 continue
-            while not self.send_queue.empty():
+            if self._sending_pending():
                 self.sync()
-                self._send_from_queue()
+                self._send_from_queue(self.send_budget)
             self._check_retries()
         self.socket.close()
         self.socket = None
 
 
 class UdpcpConnection(UdpcpConnectionInternal):
-    def send(self, msg):
+    def send(self, msg, priority=PRIORITY_NORMAL):
         """
-        Send message (adds to sending queue).
+        Send message (adds to sending queue). May be called from any thread.
         """
-        self.send_queue.put([msg])
+        self.send_multipart_message([msg], priority)
 
     def start_listener(self):
         """
@@ -336,43 +521,95 @@ class UdpcpConnection(UdpcpConnectionInternal):
         self.logger.info("Listening stopped.")
         self.alive = False
 
+    def save_state(self, path):
+        """
+        Save protocol state to file (listener must not be running and there must
+        be nothing left to send).
+        """
+        udpcpstate.save_state(self, path)
+
+    def restore_state(self, path, max_age=udpcpstate.MAX_STATE_AGE):
+        """
+        Resume from state saved with save_state, instead of sync, if state is not
+        older than max_age seconds (and was saved for the same target and
+        checksum). Connection must be new. Nothing is checked with peer.
+        Returns True if state was restored (see udpcpstate.restore_state).
+        """
+        return udpcpstate.restore_state(self, path, max_age)
+
     def create_multipart_message(self, payload):
         """
         Create one- or multi- part message from payload.
         """
+        # larger payloads cannot be sent uncompressed either (dataLength)
+        if (self.compression and
+                self.compression_threshold <= len(payload) <= MAX_DECOMPRESSED_SIZE):
+            msgs = self._create_compressed_message(payload)
+            if msgs is not None:
+                return msgs
         msgs = []
         inx = 0
         while inx < len(payload):
-            m = (UdpcpMessage(payload=payload[inx:inx+self.max_payload_size]))
+            m = UdpcpMessage(payload=payload[inx:inx+self.max_payload_size],
+                             checksum_backend=self.checksum_backend)
             m.header.dataLength = len(payload)
             m.update_checksum()
             msgs.append(m)
             inx += self.max_payload_size
         return msgs
 
-    def send_multipart_message(self, msg_list):
+    def _create_compressed_message(self, payload):
+        """
+        Create message parts from compressed payload. Payload is compressed in
+        steps and cut into parts as compressed data comes.
+        Returns None if compressed payload is not smaller than original.
+        """
+        size = self.max_payload_size
+        chunks = []
+        compressor = zlib.compressobj()
+        pending = ''
+        steps = (compressor.compress(buffer(payload, inx, COMPRESSION_STEP))
+                 for inx in xrange(0, len(payload), COMPRESSION_STEP))
+        # None -- end of payload, flush compressor
+        for data in itertools.chain(steps, [None]):
+            pending += compressor.flush() if data is None else data
+            # whole parts only, the rest waits for more data
+            end = len(pending) - len(pending) % size
+            chunks.extend(pending[start:start + size] for start in xrange(0, end, size))
+            pending = pending[end:]
+            if len(chunks) * size >= len(payload):
+                return None
+        if pending:
+            chunks.append(pending)
+
+        length = sum(len(c) for c in chunks)
+        if length >= len(payload):
+            return None
+        msgs = []
+        for chunk in chunks:
+            m = UdpcpMessage(payload=chunk, checksum_backend=self.checksum_backend)
+            m.header.compressed = True
+            m.header.dataLength = length
+            m.update_checksum()
+            msgs.append(m)
+        return msgs
+
+    def send_multipart_message(self, msg_list, priority=PRIORITY_NORMAL):
         """
-        Add multipart message to sending queue.
+        Add multipart message to sending queue (from any thread).
+        'priority' is one of PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW.
         """
-        self.send_queue.put(msg_list)
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError("Unknown priority: {}".format(priority))
+        self.send_queue.put((priority, msg_list, time.time()))
 
 
 def main():
     """
-    Quick testing.
+    Load generator / soak test, see udpcpload.
     """
-    conn = UdpcpConnection(target=("127.0.0.1", 10000), max_payload_size=1400)
-    conn.start_listener()
-    time.sleep(1)
-
-    # message in part
-    conn.singleAck = False
-    payload_string = """<SOAP-ENV:Envelope />""" * 20
-
-    messages_to_send = conn.create_multipart_message(payload=payload_string)
-    conn.send_multipart_message(msg_list=messages_to_send)
-    time.sleep(5)
-    conn.stop_listener()
+    import udpcpload
+    udpcpload.main()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+"""
+import zlib
+from array import array
+
+try:
+    # hardware accelerated (SSE 4.2 / ARMv8) if available
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+class ChecksumBackend(object):
+    """
+    Checksum of UDPCP datagram, calculated with checksum field (first 4 bytes)
+    set to zero.
+    """
+    name = None
+    # accepted difference between received and calculated checksum
+    tolerance = 0
+
+    def update(self, data, value=None):
+        """
+        Continue checksum calculation over data (start new one if value is None).
+        """
+        raise NotImplementedError
+
+    def calculate(self, data):
+        """
+        Calculate checksum for data (with checksum field already zeroed).
+        """
+        return self.update(buffer(data))
+
+    def calculate_for_datagram(self, data):
+        """
+        Calculate checksum for datagram as if its checksum field was zero.
+        """
+        return self.update(buffer(data, 4), self.update('\0\0\0\0'))
+
+    def verify(self, data):
+        """
+        Check if checksum in datagram is correct.
+        """
+        data = buffer(data)
+        received = ((ord(data[0]) << 24) | (ord(data[1]) << 16) |
+                    (ord(data[2]) << 8) | ord(data[3]))
+        return abs(received - self.calculate_for_datagram(data)) <= self.tolerance
+
+    def verify_many(self, datagrams):
+        """
+        Check many datagrams, returns list of bools. Datagrams without checksum
+        (useChecksum not set) are valid, ones shorter than UDPCP header are not.
+        It is still one checksum call per datagram, only attribute lookups are
+        saved -- meant for offline checks (udpcppcap), the receive path verifies
+        each datagram as it comes. Numpy prefix sums are slower than zlib here.
+        """
+        update = self.update
+        tolerance = self.tolerance
+        zero = self.update('\0\0\0\0')
+        result = []
+        for data in datagrams:
+            if len(data) < 12:
+                result.append(False)
+                continue
+            data = buffer(data)
+            if not (ord(data[4]) >> 1) & 1:
+                result.append(True)
+                continue
+            received = ((ord(data[0]) << 24) | (ord(data[1]) << 16) |
+                        (ord(data[2]) << 8) | ord(data[3]))
+            result.append(abs(received - update(buffer(data, 4), zero)) <= tolerance)
+        return result
+
+
+class Adler32Backend(ChecksumBackend):
+    """
+    Adler-32 (default UDPCP checksum).
+    """
+    name = 'adler32'
+    tolerance = 1
+
+    def update(self, data, value=None):
+        if value is None:
+            return zlib.adler32(data) & 0xffffffff
+        return zlib.adler32(data, value) & 0xffffffff
+
+
+def _crc32c_table():
+    """
+    Lookup table for software CRC-32C (Castagnoli, reflected 0x82f63b78).
+    """
+    table = array('L')
+    for n in xrange(256):
+        c = n
+        for _ in xrange(8):
+            c = (c >> 1) ^ 0x82f63b78 if c & 1 else c >> 1
+        table.append(c)
+    return table
+
+
+class Crc32cBackend(ChecksumBackend):
+    """
+    CRC-32C, for peers configured to use it instead of Adler-32.
+    Uses 'crc32c' package if installed, pure Python implementation otherwise.
+    """
+    name = 'crc32c'
+    _table = None
+
+    def update(self, data, value=None):
+        if _crc32c is not None:
+            if value is None:
+                return _crc32c.crc32c(data)
+            return _crc32c.crc32c(data, value)
+        if self._table is None:
+            Crc32cBackend._table = _crc32c_table()
+        table = self._table
+        crc = (value or 0) ^ 0xffffffff
+        for c in bytearray(data):
+            crc = table[(crc ^ c) & 0xff] ^ (crc >> 8)
+        return crc ^ 0xffffffff
+
+
+BACKENDS = {
+    Adler32Backend.name: Adler32Backend(),
+    Crc32cBackend.name: Crc32cBackend(),
+}
+
+default_backend = BACKENDS[Adler32Backend.name]
+
+
+def get_backend(name):
+    """
+    Get checksum backend by name (or backend itself).
+    """
+    if isinstance(name, ChecksumBackend):
+        return name
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown checksum backend: {}".format(name))
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+
+Load generator / soak test: runs sender-receiver UdpcpConnection pairs on
+loopback and reports throughput, ack latency (first part sent -> ack
+received), time in send queue, retries and memory usage.
+
+    python udpcpload.py --pairs 4 --rate 200 --size 1000 --size-dist exp \
+        --max-payload-size 1400 --duration 3600
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+from udpcp import UdpcpConnection
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'exp')
+# largest payload dataLength can describe
+MAX_SIZE = 0xffff
+
+
+def rss_kb():
+    """
+    Resident set size of this process in kB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    # peak RSS only, but better than nothing
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Get percentiles (nearest rank) and maximum of values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    result = dict(('p{}'.format(p), values[min(len(values) - 1, len(values) * p // 100)])
+                  for p in points)
+    result['max'] = values[-1]
+    return result
+
+
+class SizeGenerator(object):
+    """
+    Payload sizes with given distribution ('size' is mean for 'exp', maximum
+    for 'uniform').
+    """
+
+    def __init__(self, size, distribution='fixed', seed=None, maximum=MAX_SIZE):
+        if distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError("Unknown size distribution: {}".format(distribution))
+        self.size = size
+        self.maximum = maximum
+        self.distribution = distribution
+        self.random = random.Random(seed)
+
+    def next(self):
+        if self.distribution == 'uniform':
+            size = self.random.randint(1, self.size)
+        elif self.distribution == 'exp':
+            size = int(self.random.expovariate(1.0 / self.size)) + 1
+        else:
+            size = self.size
+        return min(size, self.maximum)
+
+
+class LoadPair(object):
+    """
+    Sender and receiver connected to each other on loopback.
+    """
+
+    def __init__(self, single_ack=True, no_ack=False, max_payload_size=2048,
+                 ack_delay=2.0, max_retries=8):
+        local = ('127.0.0.1', 0)
+        self.receiver = UdpcpConnection(None, local, ack_delay=ack_delay,
+                                        max_retries=max_retries,
+                                        max_payload_size=max_payload_size)
+        self.sender = UdpcpConnection(self.receiver.socket.getsockname(), local,
+                                      ack_delay=ack_delay, max_retries=max_retries,
+                                      max_payload_size=max_payload_size)
+        self.receiver.target = self.sender.socket.getsockname()
+        self.sender.singleAck = single_ack
+        self.sender.noAck = no_ack
+        self.ack_delay = ack_delay
+        # (message ID, first part sent) -> status time of messages with status
+        # for every part
+        self.reported = {}
+
+    def start(self):
+        self.receiver.start_listener()
+        self.sender.start_listener()
+
+    def stop(self):
+        for conn in (self.sender, self.receiver):
+            conn.stop_listener()
+        for conn in (self.sender, self.receiver):
+            conn.thread.join()
+
+    def send(self, payload):
+        self.sender.send_multipart_message(self.sender.create_multipart_message(payload))
+
+    def collect(self, stats):
+        """
+        Update stats with delivered messages and sender status.
+        """
+        for parts in self.receiver.received.get_many():
+            stats['delivered'] += 1
+            stats['bytes'] += sum(len(p.payload or '') for p in parts)
+
+        # status comes for every part if message is not acked or fails, only
+        # the first one is counted; times are taken by sender's listener thread
+        for status, kind, m_id, sent, done in self.sender.status_queue.get_many():
+            if m_id == 0:
+                # sync
+                continue
+            if status == 'Message sent' and kind == 'ack':
+                stats['latency'].append(done - sent)
+                stats['acked'] += 1
+                continue
+            if (m_id, sent) in self.reported:
+                continue
+            self.reported[m_id, sent] = done
+            stats['failed' if status == 'Message failed' else 'acked'] += 1
+
+        # other parts report within ack_delay of each other
+        limit = time.time() - 2 * self.ack_delay
+        for key, done in self.reported.items():
+            if done < limit:
+                del self.reported[key]
+
+
+def _new_stats():
+    return {'delivered': 0, 'bytes': 0, 'acked': 0, 'failed': 0, 'latency': []}
+
+
+def _report(pairs, stats, elapsed, start_rss):
+    """
+    Create report for interval.
+    """
+    latency = percentiles(stats['latency'])
+    queued = [q for p in pairs for q in p.sender.get_queue_latency() if q['count']]
+    count = sum(q['count'] for q in queued)
+    return {
+        'messages/s': stats['delivered'] / elapsed,
+        'kB/s': stats['bytes'] / elapsed / 1024,
+        'acked': stats['acked'],          # or sent, with noAck
+        'failed': stats['failed'],
+        'ack latency ms': (dict((k, v * 1000) for k, v in latency.iteritems())
+                           if latency else None),
+        # since start of run
+        'queue ms': ({'average': sum(q['average'] * q['count'] for q in queued) / count * 1000,
+                      'max': max(q['max'] for q in queued) * 1000} if count else None),
+        'retries': sum(p.sender.retransmissions for p in pairs),
+        'awaiting ack': sum(len(p.sender.waiting_for_ack) for p in pairs),
+        'message_parts': sum(len(p.receiver.message_parts) for p in pairs),
+        'message_history': sum(len(p.receiver.message_history) for p in pairs),
+        'rss kB': rss_kb(),
+        'rss growth kB': rss_kb() - start_rss,
+    }
+
+
+def format_report(report):
+    latency = report['ack latency ms']
+    if latency:
+        latency = 'p50 {p50:.1f} p90 {p90:.1f} p99 {p99:.1f} max {max:.1f}'.format(**latency)
+    queued = report['queue ms']
+    if queued:
+        queued = 'avg {average:.1f} max {max:.1f}'.format(**queued)
+    return ("{r[messages/s]:9.1f} msg/s {r[kB/s]:9.1f} kB/s | ack latency ms: {latency} | "
+            "queue ms: {queued} | "
+            "acked {r[acked]} failed {r[failed]} retries {r[retries]} "
+            "awaiting {r[awaiting ack]} | parts {r[message_parts]} "
+            "history {r[message_history]} | RSS {r[rss kB]} kB "
+            "({r[rss growth kB]:+d})").format(r=report, latency=latency, queued=queued)
+
+
+def run(pairs=1, rate=100.0, size=1000, size_distribution='fixed', single_ack=True,
+        no_ack=False, max_payload_size=2048, duration=10.0, interval=1.0, seed=None,
+        output=sys.stdout):
+    """
+    Run load: every pair sends 'rate' messages per second for 'duration' seconds
+    (0 -- until interrupted). Report is written every 'interval' seconds.
+    Returns report for the whole run.
+    """
+    # fragmentAmount is one byte
+    sizes = SizeGenerator(size, size_distribution, seed,
+                          min(MAX_SIZE, 0xff * max_payload_size))
+    data = os.urandom(MAX_SIZE)
+    load = [LoadPair(single_ack, no_ack, max_payload_size) for _ in xrange(pairs)]
+    for pair in load:
+        pair.start()
+
+    start_rss = rss_kb()
+    start = last_report = time.time()
+    total = _new_stats()
+    stats = _new_stats()
+    period = 1.0 / rate
+    next_send = [start] * pairs
+    try:
+        while not duration or time.time() - start < duration:
+            now = time.time()
+            for i, pair in enumerate(load):
+                while next_send[i] <= now:
+                    length = sizes.next()
+                    offset = sizes.random.randint(0, MAX_SIZE - length)
+                    pair.send(data[offset:offset + length])
+                    next_send[i] += period
+                pair.collect(stats)
+            if now - last_report >= interval:
+                output.write(format_report(_report(load, stats, now - last_report,
+                                                   start_rss)) + '\n')
+                output.flush()
+                for key in ('delivered', 'bytes', 'acked', 'failed', 'latency'):
+                    total[key] += stats[key]
+                stats = _new_stats()
+                last_report = now
+            time.sleep(max(0.0, min(min(next_send), last_report + interval) - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pair in load:
+            pair.stop()
+    for pair in load:
+        pair.collect(stats)
+    for key in ('delivered', 'bytes', 'acked', 'failed', 'latency'):
+        total[key] += stats[key]
+    report = _report(load, total, time.time() - start, start_rss)
+    output.write('total: ' + format_report(report) + '\n')
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDPCP load generator / soak test.")
+    parser.add_argument('--pairs', type=int, default=1,
+                        help="sender/receiver pairs (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help="messages per second per pair (default: %(default)s)")
+    parser.add_argument('--size', type=int, default=1000,
+                        help="message size in bytes: fixed value, maximum for "
+                             "uniform, mean for exp (default: %(default)s)")
+    parser.add_argument('--size-dist', choices=SIZE_DISTRIBUTIONS, default='fixed',
+                        help="message size distribution (default: %(default)s)")
+    parser.add_argument('--max-payload-size', type=int, default=2048,
+                        help="bytes per message part (default: %(default)s)")
+    parser.add_argument('--multi-ack', action='store_true',
+                        help="ack every part (singleAck off)")
+    parser.add_argument('--no-ack', action='store_true', help="send with noAck")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="seconds to run, 0 for soak run until Ctrl-C "
+                             "(default: %(default)s)")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="seconds between reports (default: %(default)s)")
+    parser.add_argument('--seed', type=int, help="seed for message sizes")
+    args = parser.parse_args(argv)
+    if not 0 < args.size <= MAX_SIZE:
+        parser.error("--size must be between 1 and {}".format(MAX_SIZE))
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+    run(args.pairs, args.rate, args.size, args.size_dist, not args.multi_ack,
+        args.no_ack, args.max_payload_size, args.duration, args.interval, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,8 @@
 :author: Rafal Jasicki
 :contact: rafal.jasicki@nsn.com
 """
-import zlib
 import logging
+from udpcpchecksum import default_backend
 
 logger = logging.getLogger('dev')
 
@@ -24,7 +24,9 @@ class UdpcpMessageHeader(object):
     useChecksum = True      # 1b       - if 0 'checksum' must be 0
     singleAck = True        # 1b       - ack only on last part
     duplicate = False       # 1b # 6B  - 0
-    reserved = 0b0000000    # 7b       - must be 0..
+    compressed = False      # 1b       - payload compressed (reserved bit, only
+    #                                    when both sides configured compression)
+    reserved = 0b000000     # 6b       - must be 0..
     fragmentAmount = 0x01   # 1B # 7B  - 0 or 1 for not fragmented messages
     fragmentNumber = 0x00   # 1B # 8B  - 0 for first element
     messageId = 0x0000      # 2B # 10B - unique, used to complete fragmented messages,
@@ -46,20 +48,12 @@ class UdpcpMessageHeader(object):
         self.useChecksum = bool((data[4] >> 1) % 2)
         self.singleAck = bool(data[4] % 2)
         self.duplicate = bool((data[5] >> 7) % 2)
+        self.compressed = bool((data[5] >> 6) % 2)
         self.fragmentAmount = data[6]
         self.fragmentNumber = data[7]
         self.messageId = (data[8] << 8) + data[9]
         self.dataLength = (data[10] << 8) + data[11]
 
-    def calculate_checksum_for_data(self, data):
-        """
-        Calculate checksum for data.
-        """
-        cs = zlib.adler32(buffer(data))
-        if cs % 0xffffffff != cs:
-            cs = (cs % 0xffffffff) + 1
-        return cs
-
     def to_bytes(self):
         """
         Create byte array from header.
@@ -69,7 +63,8 @@ class UdpcpMessageHeader(object):
         tmp.append((self.messageType << 6) + (self.version << 3) +
                    (int(self.noAck) << 2) + (int(self.useChecksum) << 1) +
                    int(self.singleAck))
-        tmp.append((int(self.duplicate) << 7) + self.reserved)
+        tmp.append((int(self.duplicate) << 7) + (int(self.compressed) << 6) +
+                   self.reserved)
         tmp.append(self.fragmentAmount)
         tmp.append(self.fragmentNumber)
         tmp += [self.messageId >> 8, self.messageId & 0xff]
@@ -89,6 +84,7 @@ class UdpcpMessageHeader(object):
                 "\tuseChecksum: {m.useChecksum}\n"
                 "\tsingleAck: {m.singleAck}\n"
                 "\tduplicate: {m.duplicate}\n"
+                "\tcompressed: {m.compressed}\n"
                 "\tfragmentAmount: {m.fragmentAmount:#x}\n"
                 "\tfragmentNumber: {m.fragmentNumber:#x}\n"
                 "\tmessageId: {m.messageId:#x}\n"
@@ -97,17 +93,24 @@ class UdpcpMessageHeader(object):
 
 class UdpcpMessage(object):
     payload = None
+    _wire = None            # cached wire bytes (see wire_bytes)
+    _wire_fields = None     # header fields the bytes were made from
+    _wire_payload = None
+    checksum_backend = default_backend
 
-    def __init__(self, data=None, payload=None, validate=True):
+    def __init__(self, data=None, payload=None, validate=True, checksum_backend=None):
         """
         To create message from data received from socket -- use 'data'.
         To create new message with specified payload -- use 'payload'.
         If 'validate' is False checksum will not be checked when creating message
         from socket data.
+        'checksum_backend' (see udpcpchecksum) defaults to adler32.
         """
         if payload is not None and data is not None:
             raise Exception("UDPCP message should not be created with both "
                             "binnary data and payload.")
+        if checksum_backend is not None:
+            self.checksum_backend = checksum_backend
         self.header = UdpcpMessageHeader(data)
         if data is not None:
             self.init_from_data(data, validate)
@@ -124,21 +127,17 @@ class UdpcpMessage(object):
         if len(data) > 12:
             self.payload = str(data[12:])
 
-        cs = self.header.checksum
-        self.update_checksum()
-        if validate and self.header.useChecksum and abs(cs - self.header.checksum) > 1:
+        if (validate and self.header.useChecksum and
+                not self.checksum_backend.verify(data)):
             logger.error('Corrupted UDPCP message received')
             raise CorruptedMessage("Checksum error.")
 
     @classmethod
     def calculate_checksum_for_data(cls, data):
         """
-        Calculate checksum for provided data.
+        Calculate checksum (default backend) for provided data.
         """
-        cs = zlib.adler32(buffer(data))
-        if cs % 0xffffffff != cs:
-            cs = (cs % 0xffffffff) + 1
-        return cs
+        return default_backend.calculate(data)
 
     def to_bytes(self):
         """
@@ -148,26 +147,50 @@ class UdpcpMessage(object):
             return self.header.to_bytes() + bytearray(self.payload)
         return self.header.to_bytes()
 
+    def _cache_wire(self, data):
+        """
+        Remember wire bytes for current header and payload.
+        """
+        self._wire = str(data)
+        self._wire_fields = dict(self.header.__dict__)
+        self._wire_payload = self.payload
+
+    def wire_bytes(self):
+        """
+        Get bytes to send over network. They are cached by update_checksum and
+        used while header fields and payload are unchanged -- otherwise current
+        message is serialized (checksum not recalculated).
+        """
+        if (self._wire is None or self._wire_payload is not self.payload or
+                self.header.__dict__ != self._wire_fields):
+            return str(self.to_bytes())
+        return self._wire
+
     def set_checksum(self, value):
         """
         Set checksum to defined value.
         """
+        self._wire = None
         self.header.checksum = value
 
     def update_checksum(self):
         """
-        Recalculate checksum for message.
+        Recalculate checksum for message (and cache wire bytes).
         """
+        self._wire = None
         self.header.checksum = 0
         if not self.header.useChecksum:
             return
-        self.header.checksum = self.calculate_checksum_for_data(self.to_bytes())
+        data = self.to_bytes()
+        cs = self.header.checksum = self.checksum_backend.calculate(data)
+        data[:4] = bytearray([cs >> 24, (cs >> 16) & 0xff, (cs >> 8) & 0xff, cs & 0xff])
+        self._cache_wire(data)
 
     def create_ack(self, duplicate):
         """
         Create new UDPCP ack-message (response to this message).
         """
-        m = UdpcpMessage()
+        m = UdpcpMessage(checksum_backend=self.checksum_backend)
         m.header.messageType = 0b10
         m.header.noAck = True
         m.header.singleAck = True
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+
+Offline decoding of UDPCP traffic captured to pcap file (requires numpy).
+
+    capture = UdpcpCapture('trace.pcap')
+    capture.headers                 # numpy structured array, one row per datagram
+    capture.statistics()            # per-flow statistics
+    UdpcpCapture('trace.pcap', ports=[13001])   # traffic of one port only
+
+Capture file is memory-mapped and all headers are decoded with numpy, only
+walking the pcap record list and checksums (on buffers into the capture, no
+copies) are done per packet. Ethernet (with VLAN tags),
+Linux cooked and raw IP link types with IPv4 are supported, IP fragments are
+skipped.
+"""
+import mmap
+import socket
+import struct
+import numpy as np
+from udpcpchecksum import get_backend
+
+HEADER_DTYPE = np.dtype([
+    ('time', 'f8'),
+    ('src', 'u4'),
+    ('sport', 'u2'),
+    ('dst', 'u4'),
+    ('dport', 'u2'),
+    ('offset', 'i8'),           # offset of UDPCP datagram in capture file
+    ('length', 'u2'),           # length of UDPCP datagram
+    ('checksum', 'u4'),
+    ('messageType', 'u1'),
+    ('version', 'u1'),
+    ('noAck', '?'),
+    ('useChecksum', '?'),
+    ('singleAck', '?'),
+    ('duplicate', '?'),
+    ('compressed', '?'),
+    ('fragmentAmount', 'u1'),
+    ('fragmentNumber', 'u1'),
+    ('messageId', 'u2'),
+    ('dataLength', 'u2'),
+    ('valid', '?'),             # checksum correct
+])
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+# seconds of silence in flow after which message IDs are not related to
+# earlier ones (peer may have restarted)
+EPOCH_GAP = 60.0
+
+
+class PcapError(ValueError):
+    pass
+
+
+def _u16(buf, idx):
+    """
+    Big-endian 16-bit values at indices.
+    """
+    return (buf[idx].astype(np.uint32) << 8) | buf[idx + 1]
+
+
+def _u32(buf, idx, big_endian=True):
+    """
+    32-bit values at indices.
+    """
+    b = [buf[idx + i].astype(np.uint32) for i in xrange(4)]
+    if not big_endian:
+        b.reverse()
+    return (b[0] << 24) | (b[1] << 16) | (b[2] << 8) | b[3]
+
+
+def _record_offsets(mm, header_size, big_endian):
+    """
+    Walk pcap records, return offsets of their headers (complete records only).
+    """
+    length = struct.Struct('>I' if big_endian else '<I')
+    size = len(mm)
+    offsets = []
+    off = header_size
+    while off + 16 <= size:
+        incl = length.unpack_from(mm, off + 8)[0]
+        if off + 16 + incl > size:
+            break
+        offsets.append(off)
+        off += 16 + incl
+    return np.array(offsets, dtype=np.int64)
+
+
+def _ip_offsets(buf, data, caplen, linktype):
+    """
+    Offsets of IPv4 headers for records starting at 'data'.
+    Returns (mask of records carrying IPv4, offsets).
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        ok = caplen >= 14 + 20
+        ip = data + 14
+        ethertype = np.zeros(len(data), dtype=np.uint32)
+        ethertype[ok] = _u16(buf, data[ok] + 12)
+        # up to two VLAN tags
+        for _ in xrange(2):
+            tagged = ok & ((ethertype == 0x8100) | (ethertype == 0x88a8))
+            tagged &= ip + 4 + 20 <= data + caplen
+            ethertype[tagged] = _u16(buf, ip[tagged] + 2)
+            ip[tagged] += 4
+        return ok & (ethertype == 0x0800), ip
+    if linktype == LINKTYPE_LINUX_SLL:
+        ok = caplen >= 16 + 20
+        protocol = np.zeros(len(data), dtype=np.uint32)
+        protocol[ok] = _u16(buf, data[ok] + 14)
+        return ok & (protocol == 0x0800), data + 16
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return caplen >= 20, data.copy()
+    raise PcapError("Unsupported link type: {}".format(linktype))
+
+
+def decode_headers(buf, linktype, records, big_endian=True, nanoseconds=False,
+                   ports=None):
+    """
+    Decode UDPCP headers of all UDP datagrams in pcap records.
+    'buf' is the whole capture (numpy uint8 array), 'records' offsets of record
+    headers, 'ports' UDP ports to decode (source or destination, all if None).
+    Returns array of HEADER_DTYPE ('valid' is not set).
+    """
+    data = records + 16
+    caplen = _u32(buf, records + 8, big_endian).astype(np.int64)
+    end = data + caplen
+
+    ok, ip = _ip_offsets(buf, data, caplen, linktype)
+    data, end, ip, records = data[ok], end[ok], ip[ok], records[ok]
+
+    # IPv4, UDP, not fragmented
+    ok = (buf[ip] >> 4) == 4
+    ok &= buf[ip + 9] == 17
+    ok &= (_u16(buf, ip + 6) & 0x3fff) == 0
+    udp = ip + (buf[ip] & 0xf).astype(np.int64) * 4
+    ok &= udp + 8 <= end
+    ip, udp, end, records = ip[ok], udp[ok], end[ok], records[ok]
+
+    if ports is not None:
+        ports = np.array(list(ports), dtype=np.uint32)
+        ok = np.in1d(_u16(buf, udp), ports) | np.in1d(_u16(buf, udp + 2), ports)
+        ip, udp, end, records = ip[ok], udp[ok], end[ok], records[ok]
+
+    # UDP payload long enough for UDPCP header and captured completely
+    length = _u16(buf, udp + 4).astype(np.int64) - 8
+    udpcp = udp + 8
+    ok = (length >= 12) & (udpcp + length <= end)
+    ip, udp, udpcp, length, records = ip[ok], udp[ok], udpcp[ok], length[ok], records[ok]
+
+    b4 = buf[udpcp + 4]
+    ok = (b4 >> 6 == 0b01) | (b4 >> 6 == 0b10)
+    ip, udp, udpcp, length, records, b4 = (ip[ok], udp[ok], udpcp[ok], length[ok],
+                                           records[ok], b4[ok])
+
+    h = np.zeros(len(records), dtype=HEADER_DTYPE)
+    fraction = 1e-9 if nanoseconds else 1e-6
+    h['time'] = (_u32(buf, records, big_endian) +
+                 _u32(buf, records + 4, big_endian) * fraction)
+    h['src'] = _u32(buf, ip + 12)
+    h['dst'] = _u32(buf, ip + 16)
+    h['sport'] = _u16(buf, udp)
+    h['dport'] = _u16(buf, udp + 2)
+    h['offset'] = udpcp
+    h['length'] = length
+    h['checksum'] = _u32(buf, udpcp)
+    h['messageType'] = b4 >> 6
+    h['version'] = (b4 >> 3) & 0b111
+    h['noAck'] = (b4 >> 2) & 1
+    h['useChecksum'] = (b4 >> 1) & 1
+    h['singleAck'] = b4 & 1
+    h['duplicate'] = buf[udpcp + 5] >> 7
+    h['compressed'] = (buf[udpcp + 5] >> 6) & 1
+    h['fragmentAmount'] = buf[udpcp + 6]
+    h['fragmentNumber'] = buf[udpcp + 7]
+    h['messageId'] = _u16(buf, udpcp + 8)
+    h['dataLength'] = _u16(buf, udpcp + 10)
+    return h
+
+
+def validate_checksums(buf, headers, checksum='adler32'):
+    """
+    Validate checksums of all datagrams in headers, sets and returns headers['valid'].
+    """
+    backend = get_backend(checksum)
+    # zlib/crc32c per datagram (on buffers into capture) is faster than
+    # checksums computed with numpy prefix sums
+    raw = buffer(buf)
+    valid = np.array(backend.verify_many([buffer(raw, o, n) for o, n in
+                                          zip(headers['offset'].tolist(),
+                                              headers['length'].tolist())]),
+                     dtype=bool)
+    headers['valid'] = valid | ~headers['useChecksum']
+    return headers['valid']
+
+
+def _per_flow(flow, nflows, weights=None):
+    """
+    Sum weights (or count) per flow index.
+    """
+    return np.bincount(flow, weights=weights, minlength=nflows).astype(np.int64)
+
+
+def _message_index(headers, flow, epoch_gap=EPOCH_GAP):
+    """
+    Number messages of all flows. Within flow, message IDs are unwrapped (0xffff
+    is followed by 1) and new ID epoch starts with sync (ID 0) or after
+    epoch_gap seconds without datagrams, so ID used again means new message.
+    Returns (message index of datagrams, -1 for invalid ones; flow of messages).
+    """
+    h = headers
+    rows = np.flatnonzero(h['valid'])
+    rows = rows[np.lexsort((h['time'][rows], flow[rows]))]
+    ids = h['messageId'][rows].astype(np.int64)
+    times = h['time'][rows]
+    flows = flow[rows]
+
+    epoch = np.ones(len(rows), dtype=bool)
+    diff = np.zeros(len(rows), dtype=np.int64)
+    if len(rows):
+        epoch[1:] = flows[1:] != flows[:-1]
+        epoch[1:] |= (ids[1:] == 0) & (ids[:-1] != 0)
+        if epoch_gap is not None:
+            epoch[1:] |= times[1:] - times[:-1] > epoch_gap
+        diff[1:] = ids[1:] - ids[:-1]
+    # retransmissions from before the wrap may come after it
+    wraps = np.cumsum((diff < -0x8000).astype(np.int64) - (diff > 0x8000))
+    sequence = ids + (wraps << 16)
+    epoch = np.cumsum(epoch)
+
+    order = np.lexsort((sequence, epoch))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ((epoch[order][1:] != epoch[order][:-1]) |
+               (sequence[order][1:] != sequence[order][:-1]))
+    message = np.empty(len(h), dtype=np.int64)
+    message.fill(-1)
+    message[rows[order]] = np.cumsum(new) - 1
+    message_flow = np.zeros(int(new.sum()), dtype=np.int64)
+    message_flow[message[rows]] = flow[rows]
+    return message, message_flow
+
+
+def flow_statistics(headers, epoch_gap=EPOCH_GAP):
+    """
+    Statistics per flow (direction in which data messages are sent, acks are
+    counted to the flow they acknowledge). Datagrams with invalid checksum are
+    left out of everything except 'packets' and 'invalid'. Message IDs are
+    matched within ID epochs (see _message_index).
+
+    Returns dict {(src, sport, dst, dport): {...}} with packets, data, acks,
+    invalid (checksum), retransmissions (data fragments sent again),
+    duplicate_acks, duplicate_ids (message IDs used for different messages),
+    lost_fragments (never seen fragments of messages) and ack latency
+    (seconds from first transmission to first ack of fragment).
+    """
+    h = headers
+    ack = h['messageType'] == 0b10
+    data = ~ack & h['valid']
+    ends = np.zeros(len(h), dtype=[('a', 'u4'), ('ap', 'u2'), ('b', 'u4'), ('bp', 'u2')])
+    ends['a'] = np.where(ack, h['dst'], h['src'])
+    ends['ap'] = np.where(ack, h['dport'], h['sport'])
+    ends['b'] = np.where(ack, h['src'], h['dst'])
+    ends['bp'] = np.where(ack, h['sport'], h['dport'])
+    flows, flow = np.unique(ends, return_inverse=True)
+    nflows = len(flows)
+    flow = flow.astype(np.int64)
+    # corrupted datagrams are only counted as invalid
+    ack &= h['valid']
+
+    stats = {
+        'packets': _per_flow(flow, nflows),
+        'data': _per_flow(flow[data], nflows),
+        'acks': _per_flow(flow[ack], nflows),
+        'invalid': _per_flow(flow[~h['valid']], nflows),
+        'duplicate_acks': _per_flow(flow[ack & h['duplicate']], nflows),
+    }
+
+    message, message_flow = _message_index(h, flow, epoch_gap)
+    key = (message << 8) | h['fragmentNumber']
+
+    # retransmissions: same fragment of same message sent again
+    fragments, counts = np.unique(key[data], return_counts=True)
+    stats['retransmissions'] = _per_flow(message_flow[fragments >> 8], nflows, counts - 1)
+
+    # message ID used for messages of different size
+    message = key[data] >> 8
+    variants = np.unique((message << 32) |
+                         (h['fragmentAmount'][data].astype(np.int64) << 16) |
+                         h['dataLength'][data])
+    messages, variant_counts = np.unique(variants >> 32, return_counts=True)
+    stats['duplicate_ids'] = _per_flow(message_flow[messages], nflows, variant_counts - 1)
+
+    # fragments never seen
+    amount = np.maximum(h['fragmentAmount'][data].astype(np.int64), 1)
+    order = np.argsort(message, kind='mergesort')
+    messages, starts = np.unique(message[order], return_index=True)
+    expected = np.maximum.reduceat(amount[order], starts) if len(order) else amount
+    seen = np.bincount(np.searchsorted(messages, fragments >> 8), minlength=len(messages))
+    stats['lost_fragments'] = _per_flow(message_flow[messages], nflows,
+                                        np.maximum(expected - seen, 0))
+
+    # ack latency: first transmission of fragment -> first ack of it
+    order = np.lexsort((h['time'][data], key[data]))
+    first = np.unique(key[data][order], return_index=True)[1]
+    sent_key = key[data][order][first]
+    sent_time = h['time'][data][order][first]
+    acked = ack & ~h['duplicate']
+    order = np.lexsort((h['time'][acked], key[acked]))
+    ack_key, first = np.unique(key[acked][order], return_index=True)
+    ack_time = h['time'][acked][order][first]
+    pos = np.minimum(np.searchsorted(sent_key, ack_key), max(len(sent_key) - 1, 0))
+    matched = (sent_key[pos] == ack_key) if len(sent_key) else np.zeros(0, dtype=bool)
+    latency = ack_time[matched] - sent_time[pos[matched]]
+    latency_flow = message_flow[ack_key[matched] >> 8]
+
+    result = {}
+    for i, f in enumerate(flows):
+        flow_latency = latency[latency_flow == i]
+        item = dict((name, int(values[i])) for name, values in stats.iteritems())
+        if len(flow_latency):
+            item['ack_latency'] = {
+                'count': len(flow_latency),
+                'mean': float(flow_latency.mean()),
+                'median': float(np.median(flow_latency)),
+                'p99': float(np.percentile(flow_latency, 99)),
+                'max': float(flow_latency.max()),
+            }
+        else:
+            item['ack_latency'] = None
+        result[(_ip(f['a']), int(f['ap']), _ip(f['b']), int(f['bp']))] = item
+    return result
+
+
+def _ip(value):
+    """
+    Dotted notation of IPv4 address.
+    """
+    return socket.inet_ntoa(struct.pack('>I', int(value)))
+
+
+class UdpcpCapture(object):
+    """
+    UDPCP datagrams from pcap file.
+    """
+
+    def __init__(self, path, checksum='adler32', ports=None):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < 24:
+            raise PcapError("File too short for pcap header.")
+        magic = self.mm[:4]
+        formats = {
+            '\xa1\xb2\xc3\xd4': (True, False),
+            '\xd4\xc3\xb2\xa1': (False, False),
+            '\xa1\xb2\x3c\x4d': (True, True),
+            '\x4d\x3c\xb2\xa1': (False, True),
+        }
+        if magic not in formats:
+            raise PcapError("Not a pcap file.")
+        big_endian, nanoseconds = formats[magic]
+        self.linktype = struct.unpack_from('>I' if big_endian else '<I', self.mm, 20)[0]
+        self.buf = np.frombuffer(self.mm, dtype=np.uint8)
+        records = _record_offsets(self.mm, 24, big_endian)
+        self.headers = decode_headers(self.buf, self.linktype, records,
+                                      big_endian, nanoseconds, ports)
+        validate_checksums(self.buf, self.headers, checksum)
+
+    def datagram(self, index):
+        """
+        Raw bytes of datagram (e.g. for UdpcpMessage).
+        """
+        h = self.headers[index]
+        return self.mm[h['offset']:h['offset'] + h['length']]
+
+    def statistics(self, epoch_gap=EPOCH_GAP):
+        """
+        Per-flow statistics (see flow_statistics).
+        """
+        return flow_statistics(self.headers, epoch_gap)
+
+    def close(self):
+        """
+        Release capture file.
+        """
+        self.buf = None
+        self.mm.close()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+"""
+import os
+import errno
+import fcntl
+import select
+import threading
+import time
+from collections import deque
+from Queue import Empty
+
+
+class SpscQueue(object):
+    """
+    Queue for exactly one consumer thread.
+
+    deque.append and deque.popleft are atomic, consumer takes no lock. Producers
+    (any number of threads) are serialized by a lock, so that the one that
+    makes queue non-empty wakes the consumer up. Consumer waiting for data is
+    woken up through a pipe, which also makes the queue usable with select
+    (see fileno).
+
+    Subset of Queue.Queue interface: put, put_nowait, get, get_nowait, empty,
+    qsize (queue is unbounded, task_done/join are not supported).
+    """
+
+    def __init__(self):
+        self.items = deque()
+        self._put_lock = threading.Lock()
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        """
+        Descriptor readable when there may be items in queue.
+        """
+        return self._read_fd
+
+    def _wakeup(self):
+        """
+        Wake up consumer (when queue was empty before put).
+        """
+        try:
+            os.write(self._write_fd, '\0')
+        except OSError as e:
+            # pipe full -- consumer has enough wake-ups already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain(self):
+        """
+        Remove pending wake-ups.
+        """
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Add item to queue (producer side). Queue is unbounded, so it never
+        blocks ('block' and 'timeout' are for Queue.Queue compatibility).
+        """
+        with self._put_lock:
+            self.items.append(item)
+            if len(self.items) == 1:
+                self._wakeup()
+
+    def put_nowait(self, item):
+        """
+        Add item to queue (same as put).
+        """
+        self.put(item)
+
+    def put_many(self, items):
+        """
+        Add all items to queue (producer side).
+        """
+        items = list(items)
+        with self._put_lock:
+            self.items.extend(items)
+            # consumer may have drained queue before extend -- then only new
+            # items (or less) are left
+            if items and len(self.items) <= len(items):
+                self._wakeup()
+
+    def get(self, block=True, timeout=None):
+        """
+        Take item from queue (consumer side).
+        Raises Queue.Empty if there is no item (after timeout if blocking).
+        """
+        try:
+            return self.items.popleft()
+        except IndexError:
+            if not block:
+                raise Empty
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._drain()
+            try:
+                return self.items.popleft()
+            except IndexError:
+                pass
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise Empty
+            select.select([self._read_fd], [], [], remaining)
+
+    def get_nowait(self):
+        """
+        Take item from queue, raise Queue.Empty if there is none.
+        """
+        return self.get(False)
+
+    def get_many(self, max_items=None):
+        """
+        Take up to max_items (all if None) items from queue without blocking.
+        """
+        self._drain()
+        items = []
+        try:
+            while max_items is None or len(items) < max_items:
+                items.append(self.items.popleft())
+        except IndexError:
+            pass
+        return items
+
+    def empty(self):
+        """
+        Check if queue is empty.
+        """
+        return not self.items
+
+    def qsize(self):
+        """
+        Number of items in queue.
+        """
+        return len(self.items)
+
+    def close(self):
+        """
+        Close wake-up descriptors.
+        """
+        if self._read_fd is None:
+            return
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = self._write_fd = None
+
+    def __del__(self):
+        self.close()
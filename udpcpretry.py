@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+"""
+from array import array
+
+
+def pack_key(message_id, fragment_number):
+    """
+    Pack message ID and fragment number into single integer.
+    """
+    return message_id << 8 | fragment_number
+
+
+class RetryTable(object):
+    """
+    Messages awaiting ack.
+
+    Every message occupies one slot: deadlines, first transmission times, retry
+    counts, keys and singleAck flags are kept in parallel arrays, for retransmission only the
+    serialized datagram is kept. Freed slots are reused.
+    """
+
+    def __init__(self):
+        self.slots = {}             # packed key -> slot
+        self.keys = array('L')
+        self.deadlines = array('d')
+        self.sent = array('d')
+        self.retries = array('H')
+        self.single_ack = array('B')
+        self.datagrams = []
+        self.free = []
+
+    def add(self, message_id, fragment_number, datagram, deadline, single_ack=True,
+            sent=0.0):
+        """
+        Add (or replace) message awaiting ack. 'sent' is time of first
+        transmission of the message.
+        """
+        key = pack_key(message_id, fragment_number)
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.datagrams)
+                self.keys.append(0)
+                self.deadlines.append(0.0)
+                self.sent.append(0.0)
+                self.retries.append(0)
+                self.single_ack.append(0)
+                self.datagrams.append(None)
+            self.slots[key] = slot
+        self.keys[slot] = key
+        self.deadlines[slot] = deadline
+        self.sent[slot] = sent
+        self.retries[slot] = 0
+        self.single_ack[slot] = int(single_ack)
+        self.datagrams[slot] = datagram
+        return slot
+
+    def slot(self, message_id, fragment_number):
+        """
+        Get slot of message or None if message is not awaiting ack.
+        """
+        return self.slots.get(pack_key(message_id, fragment_number))
+
+    def remove_slot(self, slot):
+        """
+        Remove message in slot from table.
+        """
+        del self.slots[self.keys[slot]]
+        self.datagrams[slot] = None
+        self.free.append(slot)
+
+    def remove(self, message_id, fragment_number):
+        """
+        Remove message from table (if present).
+        """
+        slot = self.slot(message_id, fragment_number)
+        if slot is not None:
+            self.remove_slot(slot)
+
+    def message_id(self, slot):
+        """
+        Get message ID of message in slot.
+        """
+        return self.keys[slot] >> 8
+
+    def fragment_number(self, slot):
+        """
+        Get fragment number of message in slot.
+        """
+        return self.keys[slot] & 0xff
+
+    def expired(self, t):
+        """
+        Get slots of messages with deadline before t.
+        """
+        deadlines = self.deadlines
+        return [slot for slot in self.slots.itervalues() if deadlines[slot] <= t]
+
+    def __contains__(self, item):
+        """
+        Check if (message_id, fragment_number) is awaiting ack.
+        """
+        return pack_key(*item) in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        """
+        Iterate over (message_id, fragment_number) of messages awaiting ack.
+        """
+        for key in self.slots:
+            yield key >> 8, key & 0xff
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+:copyright: NSN
+:author: Rafal Jasicki
+:contact: rafal.jasicki@nsn.com
+
+Snapshot of UDPCP connection state (last message ID, received message IDs,
+partially received messages and messages awaiting ack) for warm restart.
+
+Nothing is negotiated with the peer: state is trusted if it was saved for the
+same target and checksum backend not long ago (see restore_state). If peer has
+restarted meanwhile, it re-syncs as after any other lost state.
+
+File layout (big-endian):
+    header      MAGIC, time (d), target host (B length + bytes), checksum
+                backend name (B length + bytes), port (H), last_id (i, -1 if
+                not synchronised), number of history IDs, retry entries and
+                partial messages (3 x I)
+    history     message IDs (H each)
+    retries     key (I), retries (H), singleAck (B), length (H), datagram
+    parts       messageId (H), fragmentAmount (B), received parts (B), then
+                for every part: fragmentNumber (B), length (H), datagram
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from udpcpmessage import UdpcpMessage
+
+MAGIC = 'UDPCPST2'
+
+# older state is not used -- peer may have been restarted or re-synced meanwhile
+MAX_STATE_AGE = 30.0
+
+_HEADER = struct.Struct('>8sdB')
+_NAME = struct.Struct('>B')
+_LINK = struct.Struct('>Hi3I')
+_RETRY = struct.Struct('>IHBH')
+_MESSAGE = struct.Struct('>HBB')
+_PART = struct.Struct('>BH')
+
+
+class StateError(ValueError):
+    pass
+
+
+def _host(target):
+    """
+    Host part of address as string ('' if not set).
+    """
+    return (target and target[0]) or ''
+
+
+def save_state(conn, path):
+    """
+    Write state of (not running) connection to file. File is replaced atomically.
+    Messages not sent yet (or sent partially) are not part of the state, so
+    connection must have nothing left to send.
+    """
+    if conn._sending_pending():
+        raise StateError("Connection has messages waiting to be sent.")
+    host = _host(conn.target)
+    port = (conn.target and conn.target[1]) or 0
+    table = conn.waiting_for_ack
+    history = array('H', sorted(conn.message_history))
+    if sys.byteorder == 'little':
+        history.byteswap()
+    checksum = conn.checksum_backend.name
+    chunks = [_HEADER.pack(MAGIC, time.time(), len(host)), host,
+              _NAME.pack(len(checksum)), checksum,
+              _LINK.pack(port, -1 if conn.last_id is None else conn.last_id,
+                         len(history), len(table), len(conn.message_parts)),
+              history.tostring()]
+    for slot in sorted(table.slots.itervalues()):
+        datagram = table.datagrams[slot]
+        chunks.append(_RETRY.pack(table.keys[slot], table.retries[slot],
+                                  table.single_ack[slot], len(datagram)))
+        chunks.append(datagram)
+    for m_id, parts in sorted(conn.message_parts.iteritems()):
+        received = [p for p in parts if p is not None]
+        chunks.append(_MESSAGE.pack(m_id, len(parts), len(received)))
+        for p in received:
+            datagram = str(p.to_bytes())
+            chunks.append(_PART.pack(p.header.fragmentNumber, len(datagram)))
+            chunks.append(datagram)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(''.join(chunks))
+    os.rename(tmp, path)
+
+
+class _Reader(object):
+    """
+    Sequential reading of structures from memory-mapped file.
+    """
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.pos = 0
+
+    def unpack(self, fmt):
+        if self.pos + fmt.size > len(self.mm):
+            raise StateError("State file truncated.")
+        values = fmt.unpack_from(self.mm, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def read(self, size):
+        if self.pos + size > len(self.mm):
+            raise StateError("State file truncated.")
+        self.pos += size
+        return self.mm[self.pos - size:self.pos]
+
+
+def restore_state(conn, path, max_age=MAX_STATE_AGE):
+    """
+    Restore connection state saved by save_state into new connection (one that
+    did not send or receive anything yet). State is used only if it was saved
+    for the same target and checksum backend not more than max_age seconds ago
+    -- then sync is skipped and messages awaiting ack are retransmitted at
+    once. Otherwise nothing is restored and connection syncs as usual.
+    Returns True if state was restored.
+    """
+    if max_age is None:
+        raise ValueError("max_age must be set.")
+    if (conn.last_id is not None or len(conn.waiting_for_ack) or conn.message_parts or
+            conn.message_history):
+        raise StateError("Connection already has state.")
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _restore(conn, _Reader(mm), max_age)
+    finally:
+        mm.close()
+
+
+def _restore(conn, reader, max_age):
+    magic, saved, host_length = reader.unpack(_HEADER)
+    if magic != MAGIC:
+        raise StateError("Not a UDPCP state file.")
+    host = reader.read(host_length)
+    checksum = reader.read(reader.unpack(_NAME)[0])
+    port, last_id, history, retries, messages = reader.unpack(_LINK)
+    if (host, port) != (_host(conn.target), (conn.target and conn.target[1]) or 0):
+        conn.logger.warning("State saved for other target ({}:{}), "
+                            "not restored.".format(host, port))
+        return False
+    if checksum != conn.checksum_backend.name:
+        # peer would reject retransmitted datagrams
+        conn.logger.warning("State saved with {} checksum, not "
+                            "restored.".format(checksum))
+        return False
+    if time.time() - saved > max_age:
+        conn.logger.warning("State too old, not restored.")
+        return False
+
+    ids = array('H')
+    ids.fromstring(reader.read(history * ids.itemsize))
+    if sys.byteorder == 'little':
+        ids.byteswap()
+
+    pending = []
+    for _ in xrange(retries):
+        key, count, single_ack, length = reader.unpack(_RETRY)
+        pending.append((key, count, single_ack, reader.read(length)))
+
+    message_parts = {}
+    for _ in xrange(messages):
+        m_id, amount, received = reader.unpack(_MESSAGE)
+        parts = [None] * amount
+        for _ in xrange(received):
+            number, length = reader.unpack(_PART)
+            parts[number] = UdpcpMessage(reader.read(length), validate=False,
+                                         checksum_backend=conn.checksum_backend)
+        message_parts[m_id] = parts
+
+    # retransmit at once
+    now = time.time()
+    for key, count, single_ack, datagram in pending:
+        slot = conn.waiting_for_ack.add(key >> 8, key & 0xff, datagram, now, single_ack,
+                                        now)
+        conn.waiting_for_ack.retries[slot] = count
+    conn.message_parts = message_parts
+    conn.last_id = None if last_id < 0 else last_id
+    conn.message_history = dict.fromkeys(ids)
+    conn.logger.info("State restored ({} messages awaiting ack).".format(retries))
+    return True